@@ -1,5 +1,12 @@
 const { Telegraf, Markup } = require('telegraf');
 const mongoose = require('mongoose');
+const https = require('https');
+const crypto = require('crypto');
+
+// Optional: on Vercel, waitUntil() is the only supported way to keep the
+// invocation alive after the response has been sent.
+let waitUntil = null;
+try { ({ waitUntil } = require('@vercel/functions')); } catch (e) {}
 
 // ============================================================
 // 1. CONFIGURATION
@@ -7,10 +14,31 @@ const mongoose = require('mongoose');
 const BOT_TOKEN = process.env.BOT_TOKEN;
 const MONGODB_URI = process.env.MONGODB_URI;
 const ADMIN_IDS = (process.env.ADMIN_IDS || "").split(',').map(id => id.trim());
+// Optional: the secret_token passed to setWebhook; when set, POSTs missing
+// the matching header are rejected before any processing.
+const WEBHOOK_SECRET = process.env.WEBHOOK_SECRET;
+const WEBHOOK_SECRET_BUF = WEBHOOK_SECRET ? Buffer.from(WEBHOOK_SECRET) : null;
+
+// Constant-time comparison so the check leaks nothing about the secret;
+// a length mismatch can only reveal what an attacker already chose.
+function secretTokenMatches(header) {
+    if (typeof header !== 'string') return false;
+    const candidate = Buffer.from(header);
+    return candidate.length === WEBHOOK_SECRET_BUF.length && crypto.timingSafeEqual(candidate, WEBHOOK_SECRET_BUF);
+}
 
 if (!BOT_TOKEN) throw new Error('BOT_TOKEN is missing!');
 if (!MONGODB_URI) throw new Error('MONGODB_URI is missing!');
 
+const MAX_UPDATE_BYTES = 1048576; // 1 MiB — far above any real Telegram update
+
+// Errors always log; debug output costs nothing unless LOG_LEVEL=debug.
+const LOG_DEBUG = process.env.LOG_LEVEL === 'debug';
+const log = {
+  error: (...args) => console.error(...args),
+  debug: (...args) => { if (LOG_DEBUG) console.log(...args); }
+};
+
 // ============================================================
 // 2. DATABASE SCHEMAS
 // ============================================================
@@ -94,14 +122,18 @@ const Comment = mongoose.models.Comment || mongoose.model('Comment', commentSche
 // ============================================================
 // 3. DB CONNECTION
 // ============================================================
+// Cached in module scope so warm invocations reuse the open connection; the
+// readyState check catches connections the platform dropped while idle, which
+// would otherwise make every query on a stale warm instance fail.
 let cachedDb = null;
 async function connectToDatabase() {
-  if (cachedDb) return cachedDb;
+  if (cachedDb && mongoose.connection.readyState === 1) return cachedDb;
+  cachedDb = null;
   try {
-    cachedDb = await mongoose.connect(MONGODB_URI, { 
-        serverSelectionTimeoutMS: 5000, 
+    cachedDb = await mongoose.connect(MONGODB_URI, {
+        serverSelectionTimeoutMS: 5000,
         socketTimeoutMS: 45000,
-        bufferCommands: false 
+        bufferCommands: false
     });
     return cachedDb;
   } catch (error) { throw error; }
@@ -145,12 +177,24 @@ function getGrowthStage(days) {
     return '👑 ንጉስ (Legend)';
 }
 
-// HELPER: Generate Main Keyboard Layout
-async function getMainLayout(userId) {
-    const urgeLabel = await getConfig('urge_btn_label', '🆘 እርዳኝ');
-    const communityLabel = await getConfig('comm_btn_label', '🗣 Confessions');
-    const streakLabel = await getConfig('streak_btn_label', '📅 ቀኔን ቁጠር');
-    const channelLabel = await getConfig('channel_btn_label', '📢 ቻናሎች');
+// HELPER: Menu data cache
+// The labels, layout and custom buttons are read on every message but change
+// rarely (admin edits only), so keep them in module scope for the life of a
+// warm instance, refreshed on a short TTL and busted when an admin edits them.
+const MENU_CACHE_TTL_MS = 60000;
+let menuCache = null;
+function invalidateMenuCache() { menuCache = null; }
+
+async function getMenuData() {
+    if (menuCache && menuCache.expiresAt > Date.now()) return menuCache;
+
+    const [urgeLabel, communityLabel, streakLabel, channelLabel, customBtns] = await Promise.all([
+        getConfig('urge_btn_label', '🆘 እርዳኝ'),
+        getConfig('comm_btn_label', '🗣 Confessions'),
+        getConfig('streak_btn_label', '📅 ቀኔን ቁጠር'),
+        getConfig('channel_btn_label', '📢 ቻናሎች'),
+        CustomButton.find({})
+    ]);
 
     const defaultLayout = [[urgeLabel, streakLabel], [communityLabel, channelLabel]];
     let layoutRaw = await getConfig('keyboard_layout', defaultLayout);
@@ -161,8 +205,7 @@ async function getMainLayout(userId) {
         if (layout.length >= 2) layout[1].unshift(communityLabel); else layout.push([communityLabel]);
     }
 
-    const customBtns = await CustomButton.find({});
-    const updatedLabels = new Set(layout.flat().map(l => l.trim())); 
+    const updatedLabels = new Set(layout.flat().map(l => l.trim()));
     let tempRow = [];
     customBtns.forEach(btn => {
         if (!updatedLabels.has(btn.label.trim())) {
@@ -172,10 +215,20 @@ async function getMainLayout(userId) {
     });
     if (tempRow.length > 0) layout.push(tempRow);
 
+    const customBtnByLabel = new Map(customBtns.map(btn => [btn.label, btn]));
+    menuCache = { urgeLabel, communityLabel, streakLabel, channelLabel, customBtns, customBtnByLabel, baseLayout: layout, expiresAt: Date.now() + MENU_CACHE_TTL_MS };
+    return menuCache;
+}
+
+// HELPER: Generate Main Keyboard Layout
+async function getMainLayout(userId) {
+    const { baseLayout } = await getMenuData();
+    const layout = baseLayout.map(row => row.slice());
+
     if (ADMIN_IDS.includes(userId)) {
         if (!layout.flat().includes('🔐 Admin Panel')) layout.push(['🔐 Admin Panel']);
     }
-    
+
     return layout;
 }
 
@@ -198,7 +251,10 @@ async function sendCleanMessage(ctx, text, extra, userId) {
 // ============================================================
 // 5. BOT LOGIC
 // ============================================================
-const bot = new Telegraf(BOT_TOKEN);
+// Keep-alive agent: reuse TLS connections to api.telegram.org across calls
+// (and across warm invocations) instead of paying the handshake every time.
+const telegramAgent = new https.Agent({ keepAlive: true, maxSockets: 8 });
+const bot = new Telegraf(BOT_TOKEN, { telegram: { agent: telegramAgent } });
 
 bot.start(async (ctx) => {
   try {
@@ -216,184 +272,170 @@ bot.start(async (ctx) => {
     
     await sendCleanMessage(ctx, welcomeMsg, Markup.keyboard(layout).resize(), userId);
 
-  } catch (e) { console.error(e); }
+  } catch (e) { log.error(e); }
 });
 
 bot.command('profile', async (ctx) => {
     showProfile(ctx, String(ctx.from.id));
 });
 
+// Conversation-step dispatch: one key lookup picks the handler instead of
+// walking a chain of `state.step === ...` comparisons on every message.
+const adminStepHandlers = {
+    awaiting_broadcast_content: async (ctx, state, userId, text) => {
+        const replyMarkup = ctx.message.reply_markup;
+        const broadcastData = {
+            fromChatId: ctx.chat.id,
+            messageId: ctx.message.message_id,
+            reply_markup: replyMarkup
+        };
+
+        await setAdminStep(userId, 'awaiting_broadcast_confirm', broadcastData);
+
+        await ctx.reply('👁 **Preview:**');
+        try {
+            await ctx.telegram.copyMessage(
+                ctx.chat.id,
+                broadcastData.fromChatId,
+                broadcastData.messageId,
+                { reply_markup: broadcastData.reply_markup }
+            );
+        } catch (e) {
+            return ctx.reply('❌ Preview Error.');
+        }
+
+        return ctx.reply('✅ ይላክ? Buttons ካሉት አብረው ይላካሉ።\n\n/confirm ብለው ያረጋግጡ።');
+    },
+    awaiting_broadcast_confirm: async (ctx, state, userId, text) => {
+        if (text !== '/confirm') return ctx.reply('Type /confirm to send or /cancel to stop.');
+        const data = state.tempData;
+        const users = await User.find({});
+        let success = 0, fail = 0;
+
+        await ctx.reply(`🚀 Broadcasting to ${users.length} users...`);
+
+        const job = (async () => {
+            // Send in parallel batches instead of one-at-a-time: 25 per
+            // second stays under Telegram's ~30 msg/s global cap while the
+            // in-flight copies overlap on the keep-alive agent.
+            const BATCH_SIZE = 25;
+            for (let i = 0; i < users.length; i += BATCH_SIZE) {
+                const batch = users.slice(i, i + BATCH_SIZE);
+                const results = await Promise.allSettled(batch.map(u =>
+                    bot.telegram.copyMessage(
+                        u.userId,
+                        data.fromChatId,
+                        data.messageId,
+                        { reply_markup: data.reply_markup }
+                    )
+                ));
+                results.forEach(r => { if (r.status === 'fulfilled') success++; else fail++; });
+                if (i + BATCH_SIZE < users.length) await new Promise(r => setTimeout(r, 1000));
+            }
+            try { await bot.telegram.sendMessage(userId, `📢 **Broadcast Report**\n\n✅ Sent: ${success}\n❌ Failed: ${fail}`); } catch(e){}
+        })();
+        // The webhook's run promise settles as soon as handleUpdate returns,
+        // so the broadcast outlives the ack — register it or the sandbox can
+        // freeze mid-send.
+        if (waitUntil) waitUntil(job);
+
+        await clearAdminStep(userId);
+    },
+    awaiting_ban_id: async (ctx, state, userId, text) => { await User.findOneAndUpdate({ userId: text.trim() }, { isBanned: true }); await ctx.reply(`🚫 Banned.`); await clearAdminStep(userId); },
+    awaiting_welcome: async (ctx, state, userId, text) => { await Config.findOneAndUpdate({ key: 'welcome_msg' }, { value: text }, { upsert: true }); await ctx.reply('✅ Saved!'); await clearAdminStep(userId); },
+    awaiting_channel_name: async (ctx, state, userId, text) => { await setAdminStep(userId, 'awaiting_channel_link', { name: text }); return ctx.reply('🔗 Link:'); },
+    awaiting_channel_link: async (ctx, state, userId, text) => { await Channel.create({ name: state.tempData.name, link: text }); await ctx.reply('✅ Added!'); await clearAdminStep(userId); },
+    awaiting_motivation: async (ctx, state, userId, text) => { await Motivation.create({ text }); await ctx.reply('✅ Added!'); await clearAdminStep(userId); },
+    awaiting_btn_name: async (ctx, state, userId, text) => { await setAdminStep(userId, 'awaiting_btn_content', { label: text }); return ctx.reply('📥 Content:'); },
+    awaiting_btn_content: async (ctx, state, userId, text) => {
+        let type = 'text', content = '', caption = ctx.message.caption || '';
+        if (ctx.message.voice) { type = 'voice'; content = ctx.message.voice.file_id; }
+        else if (ctx.message.photo) { type = 'photo'; content = ctx.message.photo[ctx.message.photo.length - 1].file_id; }
+        else if (ctx.message.video) { type = 'video'; content = ctx.message.video.file_id; }
+        else if (text) { content = text; } else return ctx.reply('Invalid.');
+        await setAdminStep(userId, 'awaiting_btn_links', { label: state.tempData.label, type, content, caption });
+        return ctx.reply('🔗 Links? (Send "No" to skip)');
+    },
+    awaiting_btn_links: async (ctx, state, userId, text) => {
+        let inlineLinks = [];
+        if (text && text.toLowerCase() !== 'no') {
+            const lines = text.split('\n');
+            for (let line of lines) {
+                const parts = line.split('-');
+                if (parts.length >= 2) {
+                    const label = parts[0].trim(); const url = parts.slice(1).join('-').trim();
+                    if (label && url.startsWith('http')) inlineLinks.push({ label, url });
+                } else if (line.startsWith('http')) inlineLinks.push({ label: '🔗 Open Link', url: line.trim() });
+            }
+        }
+        await CustomButton.findOneAndUpdate({ label: state.tempData.label }, { type: state.tempData.type, content: state.tempData.content, caption: state.tempData.caption, inlineLinks: inlineLinks }, { upsert: true, new: true });
+        invalidateMenuCache();
+        await ctx.reply(`✅ Created!`); await clearAdminStep(userId);
+    }
+};
+
+const userStepHandlers = {
+    edit_nickname: async (ctx, state, userId, text) => { await User.findOneAndUpdate({ userId }, { nickname: text }); await clearAdminStep(userId); await ctx.reply('✅ Nickname updated!'); return showProfile(ctx, userId); },
+    edit_bio: async (ctx, state, userId, text) => { await User.findOneAndUpdate({ userId }, { bio: text }); await clearAdminStep(userId); await ctx.reply('✅ Bio updated!'); return showProfile(ctx, userId); },
+    edit_emoji: async (ctx, state, userId, text) => { await User.findOneAndUpdate({ userId }, { emoji: text }); await clearAdminStep(userId); await ctx.reply('✅ Emoji updated!'); return showProfile(ctx, userId); },
+    awaiting_confession: async (ctx, state, userId, text, currentUser) => {
+        if (text === '/cancel') { await clearAdminStep(userId); return ctx.reply('❌ Canceled.'); }
+        if (!text) return ctx.reply('Text only please.');
+        await Post.create({ userId, authorName: currentUser.nickname || "Anonymous", text: text, status: 'pending' });
+        await clearAdminStep(userId);
+        await ctx.reply('📜 **Received!** Sent to admins.', { parse_mode: 'Markdown' });
+    },
+    awaiting_comment: async (ctx, state, userId, text, currentUser) => {
+        if (text === '/cancel') { await clearAdminStep(userId); return ctx.reply('❌ Canceled.'); }
+        const postId = state.tempData.postId;
+        await Comment.create({ postId, userId, authorName: currentUser.nickname || "Anonymous", text: text });
+        await User.findOneAndUpdate({ userId }, { $inc: { aura: 2 } });
+        await clearAdminStep(userId);
+        await ctx.reply('✅ Comment added!');
+    },
+    awaiting_reply_comment: async (ctx, state, userId, text, currentUser) => {
+        if (text === '/cancel') { await clearAdminStep(userId); return ctx.reply('❌ Canceled.'); }
+        const commentId = state.tempData.commentId;
+        const replyName = currentUser.nickname || "Anonymous";
+        await Comment.findByIdAndUpdate(commentId, { $push: { replies: { authorName: replyName, text: text } } });
+        await clearAdminStep(userId);
+        await ctx.reply('✅ Reply sent!');
+    }
+};
+
 bot.on(['text', 'photo', 'video', 'voice'], async (ctx) => {
     if (!ctx.message) return;
     try {
         const userId = String(ctx.from.id);
-        const text = ctx.message.text; 
-        
+        const text = ctx.message.text;
+
         const currentUser = await User.findOne({ userId });
         if (currentUser && currentUser.isBanned) return;
         await User.findOneAndUpdate({ userId }, { lastActive: new Date() });
 
-        if (ctx.chat.type === 'private' && ADMIN_IDS.includes(userId)) {
+        if (ctx.chat.type === 'private') {
             const state = await getAdminState(userId);
             if (state && state.step) {
-                if (text === '/cancel') { await clearAdminStep(userId); return ctx.reply('❌ Canceled.'); }
-                
-                if (state.step === 'awaiting_broadcast_content') {
-                    const replyMarkup = ctx.message.reply_markup;
-                    const broadcastData = {
-                        fromChatId: ctx.chat.id,
-                        messageId: ctx.message.message_id,
-                        reply_markup: replyMarkup 
-                    };
-                    
-                    await setAdminStep(userId, 'awaiting_broadcast_confirm', broadcastData);
-
-                    await ctx.reply('👁 **Preview:**');
-                    try {
-                        await ctx.telegram.copyMessage(
-                            ctx.chat.id, 
-                            broadcastData.fromChatId, 
-                            broadcastData.messageId,
-                            { reply_markup: broadcastData.reply_markup } 
-                        );
-                    } catch (e) {
-                        return ctx.reply('❌ Preview Error.');
-                    }
-
-                    return ctx.reply('✅ ይላክ? Buttons ካሉት አብረው ይላካሉ።\n\n/confirm ብለው ያረጋግጡ።');
-                }
-
-                if (state.step === 'awaiting_broadcast_confirm') {
-                    if (text === '/confirm') {
-                        const data = state.tempData;
-                        const users = await User.find({});
-                        let success = 0, fail = 0;
-                        
-                        await ctx.reply(`🚀 Broadcasting to ${users.length} users...`);
-                        
-                        (async () => {
-                            for (const u of users) {
-                                try {
-                                    await bot.telegram.copyMessage(
-                                        u.userId, 
-                                        data.fromChatId, 
-                                        data.messageId,
-                                        { reply_markup: data.reply_markup } 
-                                    );
-                                    success++;
-                                } catch (e) { fail++; }
-                                await new Promise(r => setTimeout(r, 30)); 
-                            }
-                            try { await bot.telegram.sendMessage(userId, `📢 **Broadcast Report**\n\n✅ Sent: ${success}\n❌ Failed: ${fail}`); } catch(e){}
-                        })();
-
-                        await clearAdminStep(userId);
-                        return;
-                    } else {
-                        return ctx.reply('Type /confirm to send or /cancel to stop.');
-                    }
+                if (ADMIN_IDS.includes(userId)) {
+                    if (text === '/cancel') { await clearAdminStep(userId); return ctx.reply('❌ Canceled.'); }
+                    const adminHandler = adminStepHandlers[state.step];
+                    if (adminHandler) return adminHandler(ctx, state, userId, text);
                 }
-
-                if (state.step === 'awaiting_ban_id') { await User.findOneAndUpdate({ userId: text.trim() }, { isBanned: true }); await ctx.reply(`🚫 Banned.`); await clearAdminStep(userId); return; }
-                if (state.step === 'awaiting_welcome') { await Config.findOneAndUpdate({ key: 'welcome_msg' }, { value: text }, { upsert: true }); await ctx.reply('✅ Saved!'); await clearAdminStep(userId); return; }
-                if (state.step === 'awaiting_channel_name') { await setAdminStep(userId, 'awaiting_channel_link', { name: text }); return ctx.reply('🔗 Link:'); }
-                if (state.step === 'awaiting_channel_link') { await Channel.create({ name: state.tempData.name, link: text }); await ctx.reply('✅ Added!'); await clearAdminStep(userId); return; }
-                if (state.step === 'awaiting_motivation') { await Motivation.create({ text }); await ctx.reply('✅ Added!'); await clearAdminStep(userId); return; }
-                if (state.step === 'awaiting_btn_name') { await setAdminStep(userId, 'awaiting_btn_content', { label: text }); return ctx.reply('📥 Content:'); }
-                if (state.step === 'awaiting_btn_content') {
-                    let type = 'text', content = '', caption = ctx.message.caption || '';
-                    if (ctx.message.voice) { type = 'voice'; content = ctx.message.voice.file_id; }
-                    else if (ctx.message.photo) { type = 'photo'; content = ctx.message.photo[ctx.message.photo.length - 1].file_id; }
-                    else if (ctx.message.video) { type = 'video'; content = ctx.message.video.file_id; }
-                    else if (text) { content = text; } else return ctx.reply('Invalid.');
-                    await setAdminStep(userId, 'awaiting_btn_links', { label: state.tempData.label, type, content, caption });
-                    return ctx.reply('🔗 Links? (Send "No" to skip)');
-                }
-                if (state.step === 'awaiting_btn_links') {
-                    let inlineLinks = [];
-                    if (text && text.toLowerCase() !== 'no') {
-                        const lines = text.split('\n');
-                        for (let line of lines) {
-                            const parts = line.split('-');
-                            if (parts.length >= 2) {
-                                const label = parts[0].trim(); const url = parts.slice(1).join('-').trim();
-                                if (label && url.startsWith('http')) inlineLinks.push({ label, url });
-                            } else if (line.startsWith('http')) inlineLinks.push({ label: '🔗 Open Link', url: line.trim() });
-                        }
-                    }
-                    await CustomButton.findOneAndUpdate({ label: state.tempData.label }, { type: state.tempData.type, content: state.tempData.content, caption: state.tempData.caption, inlineLinks: inlineLinks }, { upsert: true, new: true });
-                    await ctx.reply(`✅ Created!`); await clearAdminStep(userId); return;
-                }
-            }
-        }
-
-        if (ctx.chat.type === 'private') {
-            const userState = await getAdminState(userId);
-            if (userState && userState.step === 'edit_nickname') { await User.findOneAndUpdate({ userId }, { nickname: text }); await clearAdminStep(userId); await ctx.reply('✅ Nickname updated!'); return showProfile(ctx, userId); }
-            if (userState && userState.step === 'edit_bio') { await User.findOneAndUpdate({ userId }, { bio: text }); await clearAdminStep(userId); await ctx.reply('✅ Bio updated!'); return showProfile(ctx, userId); }
-            if (userState && userState.step === 'edit_emoji') { await User.findOneAndUpdate({ userId }, { emoji: text }); await clearAdminStep(userId); await ctx.reply('✅ Emoji updated!'); return showProfile(ctx, userId); }
-            
-            if (userState && userState.step === 'awaiting_confession') {
-                if (text === '/cancel') { await clearAdminStep(userId); return ctx.reply('❌ Canceled.'); }
-                if (!text) return ctx.reply('Text only please.');
-                await Post.create({ userId, authorName: currentUser.nickname || "Anonymous", text: text, status: 'pending' });
-                await clearAdminStep(userId);
-                await ctx.reply('📜 **Received!** Sent to admins.', { parse_mode: 'Markdown' });
-                return;
-            }
-            
-            if (userState && userState.step === 'awaiting_comment') {
-                if (text === '/cancel') { await clearAdminStep(userId); return ctx.reply('❌ Canceled.'); }
-                const postId = userState.tempData.postId;
-                await Comment.create({ postId, userId, authorName: currentUser.nickname || "Anonymous", text: text });
-                await User.findOneAndUpdate({ userId }, { $inc: { aura: 2 } }); 
-                await clearAdminStep(userId);
-                await ctx.reply('✅ Comment added!');
-                return;
-            }
-
-            if (userState && userState.step === 'awaiting_reply_comment') {
-                if (text === '/cancel') { await clearAdminStep(userId); return ctx.reply('❌ Canceled.'); }
-                const commentId = userState.tempData.commentId;
-                const replyName = currentUser.nickname || "Anonymous";
-                await Comment.findByIdAndUpdate(commentId, { $push: { replies: { authorName: replyName, text: text } } });
-                await clearAdminStep(userId);
-                await ctx.reply('✅ Reply sent!');
-                return;
+                const userHandler = userStepHandlers[state.step];
+                if (userHandler) return userHandler(ctx, state, userId, text, currentUser);
             }
         }
 
         if (text === '🔐 Admin Panel' && ADMIN_IDS.includes(userId) && ctx.chat.type === 'private') return showAdminMenu(ctx);
 
-        const urgeLabel = await getConfig('urge_btn_label', '🆘 እርዳኝ');
-        if (text === urgeLabel) {
-            const count = await Motivation.countDocuments();
-            if (count === 0) return ctx.reply('Empty.');
-            const m = await Motivation.findOne().skip(Math.floor(Math.random() * count));
-            // FIXED: Resend Keyboard with simple text responses
-            const layout = await getMainLayout(userId);
-            return sendCleanMessage(ctx, `🛡️ **Stay Strong!**\n\n${m.text}`, { parse_mode: 'Markdown', ...Markup.keyboard(layout).resize() }, userId);
-        }
-
-        const streakLabel = await getConfig('streak_btn_label', '📅 ቀኔን ቁጠር');
-        if (text === streakLabel) return handleStreak(ctx);
+        if (!text) return;
+        const menu = await getMenuData();
+        const route = getMenuRoutes(menu).get(text);
+        if (route) return route(ctx);
 
-        const communityLabel = await getConfig('comm_btn_label', '🗣 Confessions');
-        if (text === communityLabel) {
-            if (ctx.chat.type !== 'private') {
-                return ctx.reply('⚠️ ለምስጢራዊነት ሲባል ይህ አገልግሎት በግል (Private Chat) ብቻ ነው የሚሰራው።', Markup.inlineKeyboard([[Markup.button.url('Go to Private Chat', `https://t.me/${ctx.botInfo.username}`)]]));
-            }
-            return handleConfessions(ctx);
-        }
-
-        const channelLabel = await getConfig('channel_btn_label', '📢 ቻናሎች');
-        if (text === channelLabel) {
-            const channels = await Channel.find({});
-            const btns = channels.map(c => [Markup.button.url(c.name, c.link)]);
-            return sendCleanMessage(ctx, 'Channels:', Markup.inlineKeyboard(btns), userId);
-        }
-
-        const customBtn = await CustomButton.findOne({ label: text });
+        // Custom buttons resolve from the cache too — a random group message
+        // no longer costs a Mongo lookup just to find out it isn't a button.
+        const customBtn = menu.customBtnByLabel.get(text);
         if (customBtn) {
             let extra = { parse_mode: 'Markdown' };
             if (customBtn.caption) extra.caption = customBtn.caption;
@@ -423,17 +465,23 @@ bot.on(['text', 'photo', 'video', 'voice'], async (ctx) => {
             if(sent && ctx.chat.type === 'private') await User.findOneAndUpdate({ userId }, { lastMenuId: sent.message_id });
             return;
         }
-    } catch (e) { console.error(e); }
+    } catch (e) { log.error(e); }
 });
 
+const PROFILE_EDIT_BUTTONS = [
+    [Markup.button.callback('✏️ Edit Name', 'prof_name'), Markup.button.callback('✏️ Edit Bio', 'prof_bio')],
+    [Markup.button.callback('😊 Edit Emoji', 'prof_emoji')],
+    [Markup.button.callback('🔙 Back', 'back_to_menu')]
+];
+
 async function showProfile(ctx, userId) {
     const user = await User.findOne({ userId });
     if (!user) return ctx.reply("User not found.");
     const msg = `👤 *Profile*\n\n🏷️ *Name:* ${escapeMarkdown(user.nickname)}\n🎭 *Emoji:* ${user.emoji}\n⚡️ *Aura:* ${user.aura}\n📝 *Bio:* ${escapeMarkdown(user.bio)}`;
-    
+
     const isPrivate = ctx.chat.type === 'private';
-    const buttons = isPrivate ? 
-        [[Markup.button.callback('✏️ Edit Name', 'prof_name'), Markup.button.callback('✏️ Edit Bio', 'prof_bio')], [Markup.button.callback('😊 Edit Emoji', 'prof_emoji')], [Markup.button.callback('🔙 Back', 'back_to_menu')]] :
+    const buttons = isPrivate ?
+        PROFILE_EDIT_BUTTONS :
         [[Markup.button.url('Go to Private to Edit', `https://t.me/${ctx.botInfo.username}`)]];
 
     await sendCleanMessage(ctx, msg, { parse_mode: 'MarkdownV2', ...Markup.inlineKeyboard(buttons) }, userId);
@@ -442,20 +490,60 @@ bot.action('prof_name', async ctx => { await setAdminStep(String(ctx.from.id), '
 bot.action('prof_bio', async ctx => { await setAdminStep(String(ctx.from.id), 'edit_bio'); ctx.reply('Enter bio:'); ctx.answerCbQuery(); });
 bot.action('prof_emoji', async ctx => { await setAdminStep(String(ctx.from.id), 'edit_emoji'); ctx.reply('Send emoji:'); ctx.answerCbQuery(); });
 
+// One Map lookup routes a menu tap to its handler instead of comparing the
+// text against every label in turn; rebuilt only when the menu cache refreshes.
+function getMenuRoutes(menu) {
+    if (!menu.routes) {
+        menu.routes = new Map([
+            [menu.urgeLabel, handleUrge],
+            [menu.streakLabel, handleStreak],
+            [menu.communityLabel, handleCommunity],
+            [menu.channelLabel, handleChannels]
+        ]);
+    }
+    return menu.routes;
+}
+
+async function handleUrge(ctx) {
+    const userId = String(ctx.from.id);
+    const count = await Motivation.countDocuments();
+    if (count === 0) return ctx.reply('Empty.');
+    const m = await Motivation.findOne().skip(Math.floor(Math.random() * count));
+    // FIXED: Resend Keyboard with simple text responses
+    // Plain text: skips server-side entity parsing, and admin-entered
+    // motivation text with stray * or _ can no longer 400 the send.
+    const layout = await getMainLayout(userId);
+    return sendCleanMessage(ctx, `🛡️ Stay Strong!\n\n${m.text}`, { ...Markup.keyboard(layout).resize() }, userId);
+}
+
+async function handleCommunity(ctx) {
+    if (ctx.chat.type !== 'private') {
+        return ctx.reply('⚠️ ለምስጢራዊነት ሲባል ይህ አገልግሎት በግል (Private Chat) ብቻ ነው የሚሰራው።', Markup.inlineKeyboard([[Markup.button.url('Go to Private Chat', `https://t.me/${ctx.botInfo.username}`)]]));
+    }
+    return handleConfessions(ctx);
+}
+
+async function handleChannels(ctx) {
+    const userId = String(ctx.from.id);
+    const channels = await Channel.find({});
+    const btns = channels.map(c => [Markup.button.url(c.name, c.link)]);
+    return sendCleanMessage(ctx, 'Channels:', Markup.inlineKeyboard(btns), userId);
+}
+
+// Fixed markups: built once at module load, reused for every request
+const CONFESSIONS_MENU = Markup.inlineKeyboard([
+    [Markup.button.callback('📜 Browse Confessions', 'browse_confessions_0')],
+    [Markup.button.callback('➕ Post Confession', 'write_confession')],
+    [Markup.button.callback('👤 My Profile', 'my_profile')],
+    [Markup.button.callback('🔙 Back to Menu', 'back_to_menu')]
+]);
+
 async function handleConfessions(ctx) {
     const userId = String(ctx.from.id);
     await sendCleanMessage(
         ctx,
         '🗣 **Confessions & Support**',
-        {
-            parse_mode: 'Markdown',
-            ...Markup.inlineKeyboard([
-                [Markup.button.callback('📜 Browse Confessions', 'browse_confessions_0')],
-                [Markup.button.callback('➕ Post Confession', 'write_confession')],
-                [Markup.button.callback('👤 My Profile', 'my_profile')],
-                [Markup.button.callback('🔙 Back to Menu', 'back_to_menu')] 
-            ])
-        },
+        { parse_mode: 'Markdown', ...CONFESSIONS_MENU },
         userId
     );
 }
@@ -493,8 +581,10 @@ bot.action(/^browse_confessions_(\d+)$/, async ctx => {
     const page = parseInt(ctx.match[1]);
     const limit = 10;
     const skip = page * limit;
-    const posts = await Post.find({ status: 'approved' }).sort({ createdAt: -1 }).skip(skip).limit(limit);
-    const totalPosts = await Post.countDocuments({ status: 'approved' });
+    const [posts, totalPosts] = await Promise.all([
+        Post.find({ status: 'approved' }).sort({ createdAt: -1 }).skip(skip).limit(limit),
+        Post.countDocuments({ status: 'approved' })
+    ]);
     
     if (posts.length === 0 && page === 0) { await ctx.reply('No confessions yet.'); return ctx.answerCbQuery(); }
 
@@ -519,10 +609,11 @@ bot.action(/^browse_confessions_(\d+)$/, async ctx => {
 
 bot.action(/^view_conf_(.+)$/, async ctx => {
     try {
-        const post = await Post.findById(ctx.match[1]);
+        const [post, commentCount] = await Promise.all([
+            Post.findById(ctx.match[1]),
+            Comment.countDocuments({ postId: ctx.match[1] })
+        ]);
         if (!post) return ctx.answerCbQuery('Deleted');
-
-        const commentCount = await Comment.countDocuments({ postId: post._id });
         const upCount = post.upvotes ? post.upvotes.length : 0;
         const downCount = post.downvotes ? post.downvotes.length : 0;
         const idDisplay = post.confessionId ? `#${post.confessionId}` : 'Confession';
@@ -557,7 +648,7 @@ bot.action(/^view_conf_(.+)$/, async ctx => {
             }, String(ctx.from.id));
         }
         await ctx.answerCbQuery();
-    } catch(e) { console.error(e); ctx.answerCbQuery("Error"); }
+    } catch(e) { log.error(e); ctx.answerCbQuery("Error"); }
 });
 
 bot.action(/^vote_(up|down)_(.+)$/, async ctx => {
@@ -606,8 +697,10 @@ bot.action(/^view_comments_([a-f\d]+)_(\d+)$/, async ctx => {
     const limit = 1; 
     const skip = page * limit;
 
-    const comments = await Comment.find({ postId: postId }).sort({ createdAt: 1 }).skip(skip).limit(limit);
-    const totalComments = await Comment.countDocuments({ postId: postId });
+    const [comments, totalComments] = await Promise.all([
+        Comment.find({ postId: postId }).sort({ createdAt: 1 }).skip(skip).limit(limit),
+        Comment.countDocuments({ postId: postId })
+    ]);
 
     if (totalComments === 0) {
         await ctx.reply('No comments yet.');
@@ -685,7 +778,7 @@ async function handleStreak(ctx) {
         const msg = `🔥 *${name}*\n\n📆 Streak: *${diff} Days*\n🌱 Level: *${escapedStage}*\n🏆 Best: ${user.bestStreak}`;
         
         await sendCleanMessage(ctx, msg, { parse_mode: 'MarkdownV2', ...Markup.inlineKeyboard([[Markup.button.callback('💔 Relapse', `rel_${userId}`)], [Markup.button.callback('🏆 Leaderboard', `led_${userId}`)], [Markup.button.callback('🔄 Refresh', `ref_${userId}`)], [Markup.button.callback('🔙 Back', `back_to_menu`)]]) }, userId);
-    } catch(e) { console.error("Streak Error:", e); }
+    } catch(e) { log.error("Streak Error:", e); }
 }
 
 bot.action(/^led_(.+)$/, async ctx => {
@@ -705,7 +798,7 @@ bot.action(/^led_(.+)$/, async ctx => {
         });
         await ctx.editMessageText(msg, { parse_mode: 'HTML', ...Markup.inlineKeyboard([[Markup.button.callback('🔙 Back', `ref_${ctx.match[1]}`)]]) });
     } catch (e) { 
-        console.error(e); 
+        log.error(e); 
         ctx.answerCbQuery("Error loading leaderboard."); 
     }
 });
@@ -717,8 +810,10 @@ bot.action(/^ref_(.+)$/, async ctx => { if(!verify(ctx, ctx.match[1])) return ct
 bot.action(/^can_(.+)$/, async ctx => { if(!verify(ctx, ctx.match[1])) return ctx.answerCbQuery('Not allowed'); try{await ctx.deleteMessage();}catch(e){} ctx.answerCbQuery(); });
 
 async function showAdminMenu(ctx) {
-    const c = await User.countDocuments();
-    const p = await Post.countDocuments({ status: 'pending' });
+    const [c, p] = await Promise.all([
+        User.countDocuments(),
+        Post.countDocuments({ status: 'pending' })
+    ]);
     await sendCleanMessage(ctx, `⚙️ Admin (Users: ${c})`, Markup.inlineKeyboard([
         [Markup.button.callback(`⏳ Approvals (${p})`, 'adm_approve')],
         [Markup.button.callback('📢 Broadcast', 'adm_cast'), Markup.button.callback('🔨 Ban', 'adm_ban')],
@@ -753,20 +848,66 @@ bot.action('add_ch', c => ask(c, 'awaiting_channel_name', 'Name:'));
 bot.action(/^del_ch_(.+)$/, async c => { await Channel.findByIdAndDelete(c.match[1]); c.reply('Deleted'); c.answerCbQuery(); });
 bot.action('adm_cus', async c => { const b = await CustomButton.find({}); c.editMessageText('Custom:', Markup.inlineKeyboard([[Markup.button.callback('➕ Add', 'add_cus')], ...b.map(x=>[Markup.button.callback(`🗑️ ${x.label}`, `del_cus_${x._id}`)])])); });
 bot.action('add_cus', c => ask(c, 'awaiting_btn_name', 'Name:'));
-bot.action(/^del_cus_(.+)$/, async c => { await CustomButton.findByIdAndDelete(c.match[1]); c.reply('Deleted'); c.answerCbQuery(); });
+bot.action(/^del_cus_(.+)$/, async c => { await CustomButton.findByIdAndDelete(c.match[1]); invalidateMenuCache(); c.reply('Deleted'); c.answerCbQuery(); });
+
+// First line of dedupe defense: update_ids this instance has already seen.
+// Catches immediate Telegram retries without a Mongo round-trip; the
+// ProcessedUpdate collection still covers replays across instances.
+const SEEN_UPDATES_MAX = 1000;
+const seenUpdates = new Set();
+function markUpdateSeen(updateId) {
+    if (seenUpdates.size >= SEEN_UPDATES_MAX) {
+        seenUpdates.delete(seenUpdates.values().next().value);
+    }
+    seenUpdates.add(updateId);
+}
 
 module.exports = async (req, res) => {
     if (req.method === 'GET') return res.status(200).send('Active');
     if (req.method === 'POST') {
+        if (WEBHOOK_SECRET && !secretTokenMatches(req.headers['x-telegram-bot-api-secret-token'])) {
+            return res.status(401).send('Unauthorized');
+        }
+        // Telegram updates are tiny; anything near a megabyte is junk traffic
+        // and gets rejected before the body is even looked at.
+        if (Number(req.headers['content-length'] || 0) > MAX_UPDATE_BYTES) {
+            return res.status(413).send('Payload too large');
+        }
+        // req.body is already parsed by the platform; anything without an
+        // update_id is not a Telegram update, so skip the DB work entirely.
         const update = req.body;
+        if (!update || typeof update.update_id !== 'number') return res.status(200).send('OK');
         const logic = async () => {
+            if (seenUpdates.has(update.update_id)) return;
+            markUpdateSeen(update.update_id);
             await connectToDatabase();
             try { await ProcessedUpdate.create({ update_id: update.update_id }); } catch(e) { if(e.code===11000) return; throw e; }
             await bot.handleUpdate(update);
         };
-        try { await Promise.race([logic(), new Promise((_, r) => setTimeout(() => r(new Error('Timeout')), 9000))]); } catch(e) {}
+        const run = Promise.race([logic(), new Promise((_, r) => setTimeout(() => r(new Error('Timeout')), 9000))])
+            .catch((e) => {
+                // The timeout sentinel is expected back-pressure; anything else
+                // is a real failure and should not vanish silently.
+                if (e && e.message === 'Timeout') log.debug(`Update ${update.update_id} timed out`);
+                else log.error('Update processing failed:', e);
+            });
+        if (waitUntil) {
+            // Ack first: Telegram only needs the 200, and a slow handler would
+            // otherwise trigger retries (and eventually webhook suspension).
+            // waitUntil() keeps the invocation alive until processing settles.
+            res.status(200).send('OK');
+            waitUntil(run);
+        } else {
+            // Without waitUntil there is no safe way to outlive the response,
+            // so finish the work before acking.
+            await run;
+            res.status(200).send('OK');
+        }
+        return;
     }
     res.status(200).send('OK');
 };
+// The self-hosted runner enforces the same cap while streaming the body.
+module.exports.MAX_UPDATE_BYTES = MAX_UPDATE_BYTES;
 
 
@@ -0,0 +1,51 @@
+// Self-hosted / local runner. On Vercel the platform invokes api/index.js
+// directly, so this only matters off-platform: it wraps the same handler in
+// bare node:http — no web framework in the path — and shims the req.body /
+// res.status().send() conventions the handler expects.
+const http = require('http');
+const handler = require('./api/index.js');
+const { MAX_UPDATE_BYTES } = handler;
+
+const PORT = process.env.PORT || 3000;
+
+http.createServer((req, res) => {
+    res.status = (code) => { res.statusCode = code; return res; };
+    res.send = (body) => res.end(body);
+
+    // Enforce the size cap while streaming: a declared oversize body is
+    // rejected before reading, and a chunked or lying client is cut off as
+    // soon as the accumulated bytes cross the limit, so an oversized POST is
+    // never fully buffered in memory.
+    if (Number(req.headers['content-length'] || 0) > MAX_UPDATE_BYTES) {
+        res.statusCode = 413;
+        res.end('Payload too large');
+        req.destroy();
+        return;
+    }
+
+    const chunks = [];
+    let received = 0;
+    let rejected = false;
+    req.on('data', (c) => {
+        if (rejected) return;
+        received += c.length;
+        if (received > MAX_UPDATE_BYTES) {
+            rejected = true;
+            res.statusCode = 413;
+            res.end('Payload too large');
+            req.destroy();
+            return;
+        }
+        chunks.push(c);
+    });
+    req.on('end', () => {
+        if (rejected) return;
+        if (chunks.length > 0) {
+            try { req.body = JSON.parse(Buffer.concat(chunks)); } catch (e) { req.body = null; }
+        }
+        handler(req, res).catch((e) => {
+            console.error(e);
+            if (!res.writableEnded) { res.statusCode = 500; res.end(); }
+        });
+    });
+}).listen(PORT, () => console.log(`Bot webhook listening on :${PORT}`));